@@ -1,5 +1,7 @@
 from __future__ import absolute_import
 
+import os
+import time
 import tempfile
 import unittest
 import requests
@@ -151,4 +153,42 @@ class ClientTest(unittest.TestCase, CustomAssertions):
                 self.assertTransitions(device, expected_transitions)
                 self.assertIdlePins(opts, device)
 
+    def test_partial_badge_scan(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            opts = get_default_opts(temp_dir)
+            badge_code = '0123456789AB'
+
+            def login_response(url, *args, **kwargs):
+                # Only the complete badge is authorized, so a scan mangled by earlier noise can not log in
+                return valid_login_response if url.endswith('/code/' + badge_code) else invalid_login_response
+
+            with patch.object(requests, 'get', side_effect=login_response), VirtualDevice(opts) as device:
+
+                expected_transitions = [
+                    State.INITIALIZED,
+                    State.IDLE
+                ]
+
+                # Assert that the device has initialized and is idle
+                self.assertTransitions(device, expected_transitions)
+                self.assertIdlePins(opts, device)
+
+                # Assert that a single byte, or a few bytes without a line ending, on the serial port are dropped,
+                # and the client goes back to blocking instead of spinning on, or hanging in, the serial port
+                for noise in ['x', 'noise']:
+                    device.write_serial(noise)
+                    time.sleep(0.5)
+                    user_time = os.times()[0]
+                    time.sleep(2)
+                    self.assertLess(os.times()[0] - user_time, 0.5)
+                    self.assertEqual(device.serial_in_waiting(), 0)
+                    self.assertTransitions(device, expected_transitions)
+                    self.assertIdlePins(opts, device)
+
+                # Assert that the client is still reading badges once the noise has been dropped
+                device.scan_badge(badge_code)
+                expected_transitions.append(State.IN_USE)
+                self.assertTransitions(device, expected_transitions)
+                self.assertInUsePins(opts, device)
+
     #TODO: test that an unexpected exception terminates the client and schedules a reboot
@@ -32,7 +32,7 @@ class VirtualDevice(object):
 	self.__lcd_patcher.start()
 
         #TODO: should only patch if the address, matches the option for the serial address
-        self.__serial_patcher = patch.object(serial, 'Serial', return_value=self.__virtual_serial)
+        self.__serial_patcher = patch.object(serial, 'Serial', side_effect=self.__virtual_serial.open)
         self.__serial_patcher.start()
 
         self.__client__update_status = patch.object(Client, 'update_status', side_effect=self.__update__status, autospec=True)
@@ -71,6 +71,12 @@ class VirtualDevice(object):
     def scan_badge(self, badge_code):
         self.__virtual_serial.scan_badge(badge_code)
 
+    def write_serial(self, data):
+        self.__virtual_serial.write_input(data)
+
+    def serial_in_waiting(self):
+        return self.__virtual_serial.inWaiting()
+
     def hold_logout(self, hold_time=None):
         pin_logout = self.__opts.get(ClientOption.PIN_LOGOUT)
         hold_time = hold_time if hold_time is not None else 0.5
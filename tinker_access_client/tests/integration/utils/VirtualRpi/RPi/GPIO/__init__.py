@@ -1,4 +1,5 @@
 import copy
+import time
 import threading
 from mock import Mock
 
@@ -60,6 +61,8 @@ class GPIO(object):
     PUD_UP = 2
 
     RISING = True
+    FALLING = 32
+    BOTH = 33
 
     setmode = Mock()
     cleanup = Mock()
@@ -108,6 +111,16 @@ class GPIO(object):
     def output(self, pin, status):
         self.__write_to_pin(pin, status)
 
+    def wait_for_edge(self, pin, direction, timeout=-1):
+        expected_status = direction != self.FALLING
+        current = time.time()
+        while timeout < 0 or (time.time() - current) * 1000 < timeout:
+            if self.input(pin) == expected_status:
+                return pin
+            time.sleep(0.01)
+
+        return None
+
     def input(self, target):
         for rows in self.__pins:
             for pin in rows:
@@ -1,21 +1,62 @@
+import os
+import fcntl
+import threading
+
+
 class VirtualSerial(object):
 
-    def __init__(self, *args):
-        self.__badge_code = None
+    def __init__(self, *args, **kwargs):
+        self.__timeout = None
+        self.__input = ''
+        self.__input_changed = threading.Condition()
+
+        # The client selects on the serial port, so any pending input makes this pipe readable until flushed
+        self.__read_fd, self.__write_fd = os.pipe()
+        fcntl.fcntl(self.__read_fd, fcntl.F_SETFL, fcntl.fcntl(self.__read_fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+
+    def open(self, *args, **kwargs):
+        # Stands in for the serial.Serial constructor, so the port keeps the timeout the client opened it with
+        self.__timeout = kwargs.get('timeout')
+        return self
+
+    def fileno(self):
+        return self.__read_fd
 
     # noinspection PyPep8Naming
     def flushInput(self, *args):
-        self.__badge_code = None
+        with self.__input_changed:
+            self.__input = ''
+            self.__input_changed.notify_all()
+        try:
+            os.read(self.__read_fd, 4096)
+        except OSError:
+            pass
 
     # noinspection PyPep8Naming
     def flushOutput(self, *args):
         pass
 
     def inWaiting(self, *args):
-        return len(self.__badge_code) if self.__badge_code is not None else 0
+        return len(self.__input)
 
     def readline(self, *args):
-        return self.__badge_code
+        # Like pyserial, blocks until a newline arrives, or returns what it has once the timeout expires
+        with self.__input_changed:
+            if '\n' not in self.__input:
+                if self.__timeout is None:
+                    while self.__input and '\n' not in self.__input:
+                        self.__input_changed.wait(1)
+                else:
+                    self.__input_changed.wait(self.__timeout)
+
+            line, newline, self.__input = self.__input.partition('\n')
+            return line + newline
+
+    def write_input(self, data):
+        with self.__input_changed:
+            self.__input += data
+            self.__input_changed.notify_all()
+        os.write(self.__write_fd, b'.')
 
     def scan_badge(self, badge_code):
-        self.__badge_code = badge_code
\ No newline at end of file
+        self.write_input(badge_code + '\r\n')
@@ -0,0 +1,51 @@
+from __future__ import absolute_import
+
+import datetime
+import unittest
+from mock import patch
+
+from tinker_access_client.tinker_access_client import Client as client_module
+from tinker_access_client.tinker_access_client.Client import Client, seconds_of_day
+
+
+def is_normal_hours(start, end, hour, minute, second=0):
+    # Only the precomputed window is read, so a plain object stands in for a fully constructed client
+    class NormalHours(object):
+        _Client__normal_hours = (seconds_of_day(start), seconds_of_day(end))
+
+    with patch.object(client_module, 'datetime') as mock_datetime:
+        mock_datetime.datetime.now.return_value = datetime.datetime(2017, 1, 1, hour, minute, second)
+        return Client.is_normal_hours.__func__(NormalHours())
+
+
+class TestClient(unittest.TestCase):
+
+    def test_seconds_of_day(self):
+        self.assertEqual(seconds_of_day(0), 0)
+        self.assertEqual(seconds_of_day(730), (7 * 60 + 30) * 60)
+        self.assertEqual(seconds_of_day(2200), 22 * 60 * 60)
+
+    def test_seconds_of_day_clamping(self):
+        self.assertEqual(seconds_of_day(-5), 0)
+        self.assertEqual(seconds_of_day(2400), (23 * 60 + 59) * 60)
+        self.assertEqual(seconds_of_day(1275), (12 * 60 + 59) * 60)
+
+    def test_normal_window(self):
+        self.assertFalse(is_normal_hours(800, 1700, 7, 59, 59))
+        self.assertTrue(is_normal_hours(800, 1700, 8, 0))
+        self.assertTrue(is_normal_hours(800, 1700, 12, 30))
+        self.assertFalse(is_normal_hours(800, 1700, 23, 0))
+
+    def test_midnight_spanning_window(self):
+        self.assertTrue(is_normal_hours(1800, 200, 18, 0))
+        self.assertTrue(is_normal_hours(1800, 200, 23, 59, 59))
+        self.assertTrue(is_normal_hours(1800, 200, 0, 0))
+        self.assertTrue(is_normal_hours(1800, 200, 1, 30))
+        self.assertFalse(is_normal_hours(1800, 200, 2, 0, 1))
+        self.assertFalse(is_normal_hours(1800, 200, 12, 0))
+        self.assertFalse(is_normal_hours(1800, 200, 17, 59, 59))
+
+    def test_end_minute_boundary(self):
+        self.assertTrue(is_normal_hours(800, 2200, 21, 59, 59))
+        self.assertTrue(is_normal_hours(800, 2200, 22, 0, 0))
+        self.assertFalse(is_normal_hours(800, 2200, 22, 0, 1))
@@ -0,0 +1,52 @@
+from __future__ import absolute_import
+
+import unittest
+from mock import patch
+
+from tinker_access_client.tinker_access_client import LcdApi as lcd_api_module
+from tinker_access_client.tinker_access_client.LcdApi import LcdApi
+
+first_line = '   SCAN BADGE   '
+second_line = '    TO LOGIN    '
+
+
+class TestLcdApi(unittest.TestCase):
+
+    def setUp(self):
+        i2c_device_patcher = patch.object(lcd_api_module.I2CApi, 'i2c_device')
+        i2c_device_patcher.start()
+        self.addCleanup(i2c_device_patcher.stop)
+
+        self.lcd = LcdApi({}, init=False)
+        self.lcd_device = self.lcd.lcd_device
+
+    def __display_string_stream(self, *lines):
+        # The bytes the line at a time path puts on the bus, one write_cmd (and its padding zero) per byte
+        self.lcd_device.reset_mock()
+        for line, text in enumerate(lines, 1):
+            self.lcd.lcd_display_string(text, line, 0)
+        return [args[0] for args, kwargs in self.lcd_device.write_cmd.call_args_list]
+
+    def __write_frame_blocks(self, *lines):
+        self.lcd_device.reset_mock()
+        self.lcd.write_frame(*lines)
+        self.assertFalse(self.lcd_device.write_cmd.called)
+        return [args for args, kwargs in self.lcd_device.write_block_data.call_args_list]
+
+    def test_write_frame_matches_display_string(self):
+        for lines in [(first_line, second_line), ('SHORT', ''), ('', '')]:
+            expected = self.__display_string_stream(*lines)
+            blocks = self.__write_frame_blocks(*lines)
+
+            actual = []
+            for cmd, data in blocks:
+                actual += [cmd] + list(data)
+
+            self.assertEqual(actual, expected)
+
+    def test_write_frame_block_size(self):
+        blocks = self.__write_frame_blocks(first_line, second_line)
+
+        self.assertTrue(blocks)
+        for cmd, data in blocks:
+            self.assertLessEqual(len(data), 32)
@@ -1,3 +1,4 @@
+import time
 import threading
 
 from PackageInfo import PackageInfo
@@ -8,10 +9,16 @@ from CommandExecutor import CommandExecutor
 
 class AutoUpdateTimer(object):
 
+    # The timer has no thread of its own, the client's main loop waits at most seconds_until_update()
+    # for the next device event and then calls update_if_due().
+
     def __init__(self, client, opts):
         self.__opts = opts
         self.__client = client
-        self.__auto_update_timer = None
+        self.__next_update = None
+        self.__updating = threading.Event()
+        self.__auto_update = opts.get(ClientOption.AUTO_UPDATE)
+        self.__auto_update_interval = opts.get(ClientOption.AUTO_UPDATE_INTERVAL) * 60
         self.__logger = ClientLogger.setup(opts)
 
     def __enter__(self):
@@ -21,34 +28,48 @@ class AutoUpdateTimer(object):
         self.__cancel_auto_update_timer()
 
     def __cancel_auto_update_timer(self):
-        if self.__auto_update_timer:
-            self.__auto_update_timer.cancel()
-
-        self.__auto_update_timer = None
+        self.__next_update = None
 
     # noinspection PyBroadException
-    def __auto_update_timer_tick(self):
-        if not self.__client.is_in_use():
-            try:
-                CommandExecutor().execute_commands([
-                    '{0} update'.format(PackageInfo.pip_package_name)
-                ])
-            except Exception:
-                pass
+    def __run_auto_update(self):
+        try:
+            if not self.__client.is_in_use():
+                CommandExecutor().execute_argv([PackageInfo.pip_package_name, 'update'])
+        except Exception:
+            pass
+        finally:
+            self.__updating.clear()
+
+    def __start_auto_update_timer(self):
+        if self.__auto_update:
+            self.__next_update = time.time() + self.__auto_update_interval
 
+    def start(self):
         self.__start_auto_update_timer()
 
-    def __start_auto_update_timer(self):
-        self.__cancel_auto_update_timer()
+    def seconds_until_update(self):
+        next_update = self.__next_update
+        if next_update is None:
+            return None
 
-        auto_update = self.__opts.get(ClientOption.AUTO_UPDATE)
-        if auto_update:
-            auto_update_interval = self.__opts.get(ClientOption.AUTO_UPDATE_INTERVAL) * 60
-            self.__auto_update_timer = threading.Timer(
-                auto_update_interval,
-                self.__auto_update_timer_tick
-            )
-            self.__auto_update_timer.start()
+        remaining = next_update - time.time()
+        if remaining > self.__auto_update_interval:
+            # The wall clock was set back (i.e. by ntp after booting without an rtc), restart the interval from now
+            self.__start_auto_update_timer()
+            remaining = self.__auto_update_interval
+
+        return max(0, remaining)
+
+    def update_if_due(self):
+        next_update = self.__next_update
+        if next_update is None or time.time() < next_update:
+            return
 
-    def start(self):
         self.__start_auto_update_timer()
+
+        # The update can take minutes, so it runs off the main loop, skipping a tick if one is still running
+        if not self.__updating.is_set():
+            self.__updating.set()
+            auto_update = threading.Thread(name='auto_update', target=self.__run_auto_update)
+            auto_update.daemon = True
+            auto_update.start()
@@ -1,4 +1,8 @@
+import os
+import sys
 import time
+import Queue
+import logging
 import datetime
 import threading
 from transitions import Machine
@@ -7,7 +11,6 @@ from State import State
 from PackageInfo import PackageInfo
 from ClientLogger import ClientLogger
 from DeviceApi import DeviceApi, Channel
-from CommandExecutor import CommandExecutor
 from AutoUpdateTimer import AutoUpdateTimer
 from TinkerAccessServerApi import TinkerAccessServerApi
 from ClientOptionParser import ClientOptionParser, ClientOption
@@ -17,6 +20,9 @@ from UnauthorizedAccessException import UnauthorizedAccessException
 maximum_lcd_characters = 16
 training_mode_delay_seconds = 2
 logout_timer_interval_seconds = 1
+relock_timer_interval_seconds = 60
+bypass_detect_settle_seconds = 0.5
+maximum_wait_seconds = 60
 
 
 class Trigger(object):
@@ -29,6 +35,51 @@ class Trigger(object):
     TERMINATE = 'terminate'
 
 
+def centered(*lines):
+    return tuple(line.center(maximum_lcd_characters, ' ') for line in lines)
+
+
+def seconds_of_day(time_of_day):
+    # Converts a clamped HHMM option value (i.e. 730 or 2200) into seconds since midnight
+    time_of_day = max(0, min(2359, time_of_day))
+    hours, minutes = divmod(time_of_day, 100)
+    return (hours * 60 + min(59, minutes)) * 60
+
+
+class Color(object):
+    OFF = (False, False, False)
+    RED = (True, False, False)
+    GREEN = (False, True, False)
+    BLUE = (False, False, True)
+    YELLOW = (True, True, False)
+    MAGENTA = (True, False, True)
+
+
+class Message(object):
+    ESTOP_ACTIVATED = centered('E-STOP ACTIVATED', 'RESET THE SWITCH')
+    BYPASSED = centered('TINKERACCESS', 'IS BYPASSED')
+    ATTEMPTING_LOGIN = centered('ATTEMPTING', 'LOGIN...')
+    ACCESS_DENIED = centered('ACCESS DENIED', 'TAKE THE CLASS')
+    SCAN_BADGE = centered('SCAN BADGE', 'TO LOGIN')
+    UNLOCKED = centered('TINKERACCESS', 'IS UNLOCKED')
+    ACCESS_GRANTED = centered('ACCESS GRANTED')
+    SESSION_EXTENDED = centered('SESSION EXTENDED')
+    NO_EXTENSIONS_REMAINING = centered('NO EXTENSIONS', 'REMAINING...')
+    TRAINING_MODE_ACTIVATED = centered('TRAINING MODE', 'ACTIVATED...')
+    SCAN_TRAINER_BADGE = centered('SCAN', 'TRAINER BADGE...')
+    TRAINER_ACCEPTED = centered('TRAINER', 'ACCEPTED...')
+    SCAN_STUDENT_BADGE = centered('SCAN', 'STUDENT BADGE...')
+    ATTEMPTING_REGISTRATION = centered('ATTEMPTING', 'REGISTRATION...')
+    STUDENT_REGISTERED = centered('STUDENT', 'REGISTERED...')
+    REGISTRATION_FAILED = centered('REGISTRATION', 'FAILED...')
+    INVALID_USER = centered('INVALID', 'USER...')
+    DISABLING_POWER = centered('DISABLING', 'POWER...')
+    WAITING_FOR_POWER_DOWN = centered('WAITING FOR ...', 'MACHINE TO STOP')
+    COASTING_DOWN = centered('COASTING', 'DOWN...')
+    ERROR_OCCURRED = centered('THERE WAS AN', 'UNEXPECTED ERROR')
+    PLEASE_TRY_AGAIN = centered('PLEASE', 'TRY AGAIN...')
+
+
 # noinspection PyUnusedLocal
 class Client(Machine):
     def __init__(self, device=None, opts=None):
@@ -37,14 +88,63 @@ class Client(Machine):
         self.__user_info = None
         self.__relock_timer = None
         self.__logout_timer = None
-        self.__logout_timer_lock = threading.Lock()        
+        self.__transition_lock = threading.RLock()
+        self.__preempted = threading.Event()
+        self.__last_status = None
+        self.__lcd_lines = None
+        self.__display_lock = threading.Lock()
+        self.__led_colors = None
+        self.__alarm_state = None
+        self.__status_file = opts.get(ClientOption.STATUS_FILE)
         self.__logger = ClientLogger.setup(opts)
+
+        # The logging handlers and their filters are fixed once the logger is setup
+        self.__user_context_updaters = [
+            context_filter.update_user_context
+            for handler in self.__logger.handlers
+            for context_filter in handler.filters
+            if callable(getattr(context_filter, 'update_user_context', None))
+        ]
         self.__tinkerAccessServerApi = TinkerAccessServerApi(opts)
 
-        states = []
-        for key, value in vars(State).items():
-            if not key.startswith('__'):
-                states.append(value)
+        # Options read while polling or on every timer tick are resolved once up front
+        self.__use_alarm = opts.get(ClientOption.USE_ALARM)
+        self.__pin_alarm = opts.get(ClientOption.PIN_ALARM)
+        self.__pin_logout = opts.get(ClientOption.PIN_LOGOUT)
+        self.__pin_power_relay = opts.get(ClientOption.PIN_POWER_RELAY)
+        self.__pin_current_sense = opts.get(ClientOption.PIN_CURRENT_SENSE)
+        self.__max_power_down_timeout = opts.get(ClientOption.MAX_POWER_DOWN_TIMEOUT)
+        self.__use_estop = opts.get(ClientOption.USE_ESTOP)
+        self.__pin_estop = opts.get(ClientOption.PIN_ESTOP)
+        self.__estop_active_hi = bool(opts.get(ClientOption.ESTOP_ACTIVE_HI))
+        self.__use_bypass_detect = opts.get(ClientOption.USE_BYPASS_DETECT)
+        self.__pin_bypass_detect = opts.get(ClientOption.PIN_BYPASS_DETECT)
+        self.__falling_edge = device.GPIO.FALLING
+        self.__estop_activated = False
+        self.__bypass_detected = False
+        self.__normal_hours = (
+            seconds_of_day(opts.get(ClientOption.DOOR_NORMAL_HR_START)),
+            seconds_of_day(opts.get(ClientOption.DOOR_NORMAL_HR_END))
+        )
+
+        # Badge scans are handled by state and whether a user is logged in, anything else is a login attempt
+        self.__badge_code_handlers = {
+            (State.IN_TRAINING, False): self.__handle_trainer_badge_code,
+            (State.IN_TRAINING, True): self.__handle_student_badge_code
+        }
+
+        # Triggers raised from inside a transition callback, run as soon as that transition has completed
+        self.__pending_triggers = []
+        self.__transition_depth = 0
+
+        # A single long lived worker runs the server calls that should not block the current transition
+        self.__work_queue = Queue.Queue()
+        self.__worker = threading.Thread(
+            name='worker',
+            target=self.__worker_loop
+        )
+        self.__worker.daemon = True
+        self.__worker.start()
 
         transitions = [
             {
@@ -106,8 +206,18 @@ class Client(Machine):
             }
         ]
 
-        Machine.__init__(self, queued=True, states=states, ignore_invalid_triggers=True,
-                         transitions=transitions, initial=State.INITIALIZED, after_state_change='update_status')
+        # Only the transitions above are ever triggered, so skip the generated to_<state>() transitions
+        Machine.__init__(self, queued=False, states=list(State.ALL), ignore_invalid_triggers=True,
+                         auto_transitions=False, transitions=transitions, initial=State.INITIALIZED,
+                         after_state_change='update_status')
+
+        # The trigger that enters the resting state for each (e-stop activated, bypass detected) pair
+        self.__resting_states = {
+            (True, True): self.estop,
+            (True, False): self.estop,
+            (False, True): self.bypass,
+            (False, False): self.idle
+        }
 
     def __enter__(self):
         self.update_status()
@@ -115,6 +225,74 @@ class Client(Machine):
 
     def __exit__(self, exc_type, exc_val, exc_tb):
         self.terminate()
+        self.__work_queue.put(None)
+        self.__worker.join()
+
+    def _process(self, trigger):
+        # Triggers arrive from the serial, gpio and timer threads, only one transition may run at a time.
+        # A trigger raised from inside a transition runs once the outermost transition has completed,
+        # still under the lock, so no other trigger can slip in between and it never waits on network calls.
+        with self.__transition_lock:
+            self.__transition_depth += 1
+            try:
+                result = Machine._process(self, trigger)
+            except Exception:
+                del self.__pending_triggers[:]
+                raise
+            finally:
+                self.__transition_depth -= 1
+
+            while not self.__transition_depth and self.__pending_triggers:
+                self.__pending_triggers.pop(0)()
+
+            return result
+
+    def __raise_after_transition(self, trigger):
+        self.__pending_triggers.append(trigger)
+
+    def __preempt(self, trigger):
+        # Cuts short any message delay in the running transition, so the e-stop and bypass triggers
+        # do not have to wait behind it for the transition lock.
+        self.__preempted.set()
+        try:
+            trigger()
+        finally:
+            self.__preempted.clear()
+
+    def __pause(self, delay):
+        if delay:
+            self.__preempted.wait(delay)
+
+    def __defer(self, call, *args):
+        self.__work_queue.put((call, args))
+
+    def __worker_loop(self):
+        while True:
+            work = self.__work_queue.get()
+            if work is None:
+                return
+
+            call, args = work
+            try:
+                call(*args)
+            except Exception as e:
+                self.__logger.exception(e)
+
+    #
+    # The LCD, LEDs and alarm sit on slow buses, so anything that is already displayed is not written again
+    #
+
+    def __write_lcd(self, *lines):
+        with self.__display_lock:
+            if lines != self.__lcd_lines:
+                self.__device.write_lcd_frame(*lines)
+                self.__lcd_lines = lines
+
+    def __write_led(self, colors):
+        with self.__display_lock:
+            if colors != self.__led_colors:
+                self.__device.write_led(colors)
+                self.__led_colors = colors
 
     #
     # estop -- The machine is in e-stop and waiting e-stop to be cleared or enter training mode
@@ -127,11 +305,7 @@ class Client(Machine):
         self.__show_estop_activated()
 
     def __show_estop_activated(self):
-        self.__device.write(
-            Channel.LCD,
-            'E-STOP ACTIVATED'.center(maximum_lcd_characters, ' '),
-            'RESET THE SWITCH'.center(maximum_lcd_characters, ' ')
-        )
+        self.__write_lcd(*Message.ESTOP_ACTIVATED)
 
     #
     # bypassed -- The machine has been bypassed and waiting for bypass to be cleared or enter training mode
@@ -144,15 +318,11 @@ class Client(Machine):
         self.__show_bypassed()
 
     def __show_yellow_led(self):
-        self.__device.write(Channel.LED, True, True, False)
+        self.__write_led(Color.YELLOW)
         self.__set_alarm_output(False)
 
     def __show_bypassed(self):
-        self.__device.write(
-            Channel.LCD,
-            'TINKERACCESS'.center(maximum_lcd_characters, ' '),
-            'IS BYPASSED'.center(maximum_lcd_characters, ' ')
-        )
+        self.__write_lcd(*Message.BYPASSED)
 
     #
     # idle -- The machine is idle and waiting for a badge to be scanned
@@ -193,40 +363,30 @@ class Client(Machine):
         return self.__user_info is not None
 
     def __show_attempting_login(self, delay=0):
-        self.__device.write(
-            Channel.LCD,
-            'ATTEMPTING'.center(maximum_lcd_characters, ' '),
-            'LOGIN...'.center(maximum_lcd_characters, ' ')
-        )
-        time.sleep(delay)
+        self.__write_lcd(*Message.ATTEMPTING_LOGIN)
+        self.__pause(delay)
 
     def __update_user_context(self, user_info):
         self.__user_info = user_info
-        for handler in self.__logger.handlers:
-            for context_filter in handler.filters:
-                update_user_context = getattr(context_filter, "update_user_context", None)
-                if callable(update_user_context):
-                    context_filter.update_user_context(self.__user_info)
+        for update_user_context in self.__user_context_updaters:
+            update_user_context(user_info)
 
     def __handle_unauthorized_access_exception(self):
         self.__show_red_led()
         self.__show_access_denied(2)
 
     def __show_access_denied(self, delay=0):
-        self.__device.write(
-            Channel.LCD,
-            'ACCESS DENIED'.center(maximum_lcd_characters, ' '),
-            'TAKE THE CLASS'.center(maximum_lcd_characters, ' ')
-        )
-        time.sleep(delay)
+        self.__write_lcd(*Message.ACCESS_DENIED)
+        self.__pause(delay)
 
     def __show_red_led(self):
-        self.__device.write(Channel.LED, True, False, False)
+        self.__write_led(Color.RED)
         self.__set_alarm_output(True)
 
     def __set_alarm_output(self, state):
-        if self.__opts.get(ClientOption.USE_ALARM):
-            self.__device.write(Channel.PIN, self.__opts.get(ClientOption.PIN_ALARM), state)
+        if self.__use_alarm and state != self.__alarm_state:
+            self.__device.write(Channel.PIN, self.__pin_alarm, state)
+            self.__alarm_state = state
 
     def __do_logout(self):
         self.__cancel_logout_timer()
@@ -234,20 +394,16 @@ class Client(Machine):
 
         if self.__user_info:
             badge_code = self.__user_info.get('badge_code')
-            threading.Timer(0, self.__tinkerAccessServerApi.logout, (badge_code, )).start()
+            self.__defer(self.__tinkerAccessServerApi.logout, badge_code)
 
         self.__update_user_context(None)
 
     def __show_blue_led(self):
-        self.__device.write(Channel.LED, False, False, True)
+        self.__write_led(Color.BLUE)
         self.__set_alarm_output(False)
 
     def __show_scan_badge(self):
-        self.__device.write(
-            Channel.LCD,
-            'SCAN BADGE'.center(maximum_lcd_characters, ' '),
-            'TO LOGIN'.center(maximum_lcd_characters, ' ')
-        )
+        self.__write_lcd(*Message.SCAN_BADGE)
 
     #
     # unlocked -- The door is held manually in a continuous unlocked state
@@ -260,40 +416,34 @@ class Client(Machine):
         self.__show_unlocked()
 
     def __show_unlocked(self):
-        self.__device.write(
-            Channel.LCD,
-            'TINKERACCESS'.center(maximum_lcd_characters, ' '),
-            'IS UNLOCKED'.center(maximum_lcd_characters, ' ')
-        )
+        self.__write_lcd(*Message.UNLOCKED)
         
     def __start_relock_timer(self):
         self.__cancel_relock_timer()
-        self.__relock_timer = threading.Timer(
-            60,
-            self.__relock_timer_tick
+        self.__relock_timer = threading.Event()
+        relock_timer = threading.Thread(
+            name='relock_timer',
+            target=self.__relock_timer_loop,
+            args=(self.__relock_timer,)
         )
-        self.__relock_timer.start()
+        relock_timer.daemon = True
+        relock_timer.start()
 
-    def __relock_timer_tick(self):
-        try:
-            if not self.is_terminated() and self.__relock_timer:
-                if not self.is_normal_hours():
-                    # Outside of normal hours, relock the door
-                    self.logout()
-                    return
+    def __relock_timer_loop(self, cancelled):
+        while not cancelled.wait(relock_timer_interval_seconds):
+            if self.is_terminated():
+                return
 
-                self.__start_relock_timer()
-        except Exception as e:
-            raise e
+            if not self.is_normal_hours():
+                # Outside of normal hours, relock the door
+                self.logout()
+                return
 
     def __cancel_relock_timer(self):
-        try:
-            if self.__relock_timer:
-                self.__relock_timer.cancel()
-        except Exception as e:
-            raise e
-        finally:
-            self.__relock_timer = None
+        relock_timer = self.__relock_timer
+        self.__relock_timer = None
+        if relock_timer:
+            relock_timer.set()
 
     #
     # in_use -- The machine is currently in use and the logout timer is ticking...
@@ -304,87 +454,92 @@ class Client(Machine):
         self.__show_green_led()
 
     def __enable_power(self):
-        self.__device.write(Channel.PIN, self.__opts.get(ClientOption.PIN_POWER_RELAY), True)
+        self.__device.write(Channel.PIN, self.__pin_power_relay, True)
 
     def __show_access_granted(self, delay=0):
-        self.__device.write(
-            Channel.LCD,
-            'ACCESS GRANTED'.center(maximum_lcd_characters, ' '),
-        )
-        time.sleep(delay)
+        self.__write_lcd(*Message.ACCESS_GRANTED)
+        self.__pause(delay)
 
     def __show_green_led(self):
-        self.__device.write(Channel.LED, False, True, False)
+        self.__write_led(Color.GREEN)
         self.__set_alarm_output(False)
 
-    def __start_logout_timer(self, refresh=False):
-        self.__cancel_logout_timer(refresh)
-        self.__logout_timer = threading.Timer(
-            logout_timer_interval_seconds,
-            self.__logout_timer_tick
+    def __start_logout_timer(self):
+        self.__cancel_logout_timer()
+        self.__logout_timer = threading.Event()
+        logout_timer = threading.Thread(
+            name='logout_timer',
+            target=self.__logout_timer_loop,
+            args=(self.__logout_timer,)
         )
-        self.__logout_timer.start()
+        logout_timer.daemon = True
+        logout_timer.start()
+
+    def __logout_timer_loop(self, signal):
+        # A single thread counts down the whole session, the event is set when the timer is cancelled,
+        # or when the session is extended and the countdown should restart its tick from the new time.
+        # Each tick holds the transition lock, so it never races a transition that is updating the session.
+        while True:
+            signal.wait(logout_timer_interval_seconds)
+            with self.__transition_lock:
+                user_info = self.__user_info
+                if self.__logout_timer is not signal:
+                    return
 
-    def __logout_timer_tick(self):
-        self.__logout_timer_lock.acquire()
-        thread_locked = True
+                if self.is_terminated() or not user_info:
+                    self.__logout_timer = None
+                    return
 
-        try:
-            if not self.is_terminated() and self.__user_info and self.__logout_timer:
-                remaining_seconds = self.__user_info.get('remaining_seconds')
+                if signal.is_set():
+                    signal.clear()
+                    continue
 
+                remaining_seconds = user_info.get('remaining_seconds')
                 if remaining_seconds <= 0:
-                    # Release the lock before triggering logout
-                    self.__logout_timer_lock.release()
-                    thread_locked = False
                     self.logout()
+                    # Logout is not valid from every state, make sure a later login starts a new countdown
+                    if self.__logout_timer is signal:
+                        self.__logout_timer = None
                     return
 
-                self.__user_info['remaining_seconds'] = (remaining_seconds - logout_timer_interval_seconds)
+                user_info['remaining_seconds'] = (remaining_seconds - logout_timer_interval_seconds)
                 self.__show_remaining_time()
-                self.__start_logout_timer(True)
-        except Exception as e:
-            raise e
-        finally:
-            if thread_locked:
-                self.__logout_timer_lock.release()
 
     def __show_remaining_time(self):
-        remaining_seconds = self.__user_info.get('remaining_seconds')
+        user_info = self.__user_info
+        if not user_info:
+            return
+
+        remaining_seconds = user_info.get('remaining_seconds')
         if remaining_seconds < 300:
             self.__toggle_red_led()
 
         m, s = divmod(int(remaining_seconds), 60)
         h, m = divmod(m, 60)
-        user_name = self.__user_info.get('user_name')
-        self.__device.write(
-            Channel.LCD,
+        user_name = user_info.get('user_name')
+        self.__write_lcd(
             user_name.center(maximum_lcd_characters, ' '),
             '{0:02d}:{1:02d}:{2:02d}'.format(h, m, s).center(maximum_lcd_characters, ' ')
         )
 
     def __toggle_red_led(self):
-        red_led_status = self.__device.read(Channel.PIN, self.__opts.get(ClientOption.PIN_LED_RED))
-        self.__device.write(Channel.LED, not red_led_status, False, False)
+        self.__write_led(Color.OFF if self.__led_colors == Color.RED else Color.RED)
         self.__set_alarm_output(True)
 
-    def __cancel_logout_timer(self, refresh=False):
-        if not refresh:
-            self.__logout_timer_lock.acquire()
+    def __cancel_logout_timer(self):
+        logout_timer = self.__logout_timer
+        self.__logout_timer = None
+        if logout_timer:
+            logout_timer.set()
 
-        try:
-            if self.__logout_timer:
-                self.__logout_timer.cancel()
-        except Exception as e:
-            raise e
-        finally:
-            self.__logout_timer = None
-            if not refresh:
-                self.__logout_timer_lock.release()
+    def __refresh_logout_timer(self):
+        logout_timer = self.__logout_timer
+        if logout_timer:
+            logout_timer.set()
+        else:
+            self.__start_logout_timer()
 
     def __extend_session(self):
-        self.__cancel_logout_timer()
-
         # TODO: add api call to let server know that time has been extended...
 
         session_seconds = self.__user_info.get('session_seconds')
@@ -403,23 +558,14 @@ class Client(Machine):
         else:
             self.__show_no_extensions_remaining(2)
 
-        self.__start_logout_timer()
-
     def __show_session_extended(self, delay=0):
-        self.__device.write(
-            Channel.LCD,
-            'SESSION EXTENDED'.center(maximum_lcd_characters, ' ')
-        )
-        time.sleep(delay)
+        self.__write_lcd(*Message.SESSION_EXTENDED)
+        self.__pause(delay)
         self.__show_remaining_time()
 
     def __show_no_extensions_remaining(self, delay=0):
-        self.__device.write(
-            Channel.LCD,
-            'NO EXTENSIONS'.center(maximum_lcd_characters, ' '),
-            'REMAINING...'.center(maximum_lcd_characters, ' ')
-        )
-        time.sleep(delay)
+        self.__write_lcd(*Message.NO_EXTENSIONS_REMAINING)
+        self.__pause(delay)
         self.__show_remaining_time()
 
     #
@@ -433,16 +579,12 @@ class Client(Machine):
         self.__show_training_mode_activated(1)
 
     def __show_magenta_led(self):
-        self.__device.write(Channel.LED, True, False, True)
+        self.__write_led(Color.MAGENTA)
         self.__set_alarm_output(False)
 
     def __show_training_mode_activated(self, delay=0):
-        self.__device.write(
-            Channel.LCD,
-            'TRAINING MODE'.center(maximum_lcd_characters, ' '),
-            'ACTIVATED...'.center(maximum_lcd_characters, ' ')
-        )
-        time.sleep(delay)
+        self.__write_lcd(*Message.TRAINING_MODE_ACTIVATED)
+        self.__pause(delay)
 
     def __activate_trainer(self, badge_code):
         # Note: currently we call the normal login method on the tinkerAccessServer
@@ -470,31 +612,19 @@ class Client(Machine):
         self.__show_scan_trainer_badge()
 
     def __show_scan_trainer_badge(self):
-        self.__device.write(
-            Channel.LCD,
-            'SCAN'.center(maximum_lcd_characters, ' '),
-            'TRAINER BADGE...'.center(maximum_lcd_characters, ' ')
-        )
+        self.__write_lcd(*Message.SCAN_TRAINER_BADGE)
 
     def __show_trainer_accepted(self, delay=0):
-        self.__device.write(
-            Channel.LCD,
-            'TRAINER'.center(maximum_lcd_characters, ' '),
-            'ACCEPTED...'.center(maximum_lcd_characters, ' ')
-        )
-        time.sleep(delay)
+        self.__write_lcd(*Message.TRAINER_ACCEPTED)
+        self.__pause(delay)
 
     def __prompt_for_student_badge(self):
         self.__show_magenta_led()
         self.__show_scan_student_badge()
 
     def __show_scan_student_badge(self, delay=0):
-        self.__device.write(
-            Channel.LCD,
-            'SCAN'.center(maximum_lcd_characters, ' '),
-            'STUDENT BADGE...'.center(maximum_lcd_characters, ' ')
-        )
-        time.sleep(delay)
+        self.__write_lcd(*Message.SCAN_STUDENT_BADGE)
+        self.__pause(delay)
 
     def __register_student(self, badge_code):
         try:
@@ -513,73 +643,63 @@ class Client(Machine):
             self.__prompt_for_student_badge()
 
     def __show_attempting_registration(self, delay=0):
-        self.__device.write(
-            Channel.LCD,
-            'ATTEMPTING'.center(maximum_lcd_characters, ' '),
-            'REGISTRATION...'.center(maximum_lcd_characters, ' ')
-        )
-        time.sleep(delay)
+        self.__write_lcd(*Message.ATTEMPTING_REGISTRATION)
+        self.__pause(delay)
 
     def __show_student_registered(self, delay=0):
-        self.__device.write(
-            Channel.LCD,
-            'STUDENT'.center(maximum_lcd_characters, ' '),
-            'REGISTERED...'.center(maximum_lcd_characters, ' ')
-        )
-        time.sleep(delay)
+        self.__write_lcd(*Message.STUDENT_REGISTERED)
+        self.__pause(delay)
 
     def __handle_user_registration_exception(self):
         self.__show_red_led()
         self.__show_registration_failed(2)
 
     def __show_registration_failed(self, delay=0):
-        self.__device.write(
-            Channel.LCD,
-            'REGISTRATION'.center(maximum_lcd_characters, ' '),
-            'FAILED...'.center(maximum_lcd_characters, ' ')
-        )
-        time.sleep(delay)
+        self.__write_lcd(*Message.REGISTRATION_FAILED)
+        self.__pause(delay)
 
     def __show_invalid_user(self, delay=0):
-        self.__device.write(
-            Channel.LCD,
-            'INVALID'.center(maximum_lcd_characters, ' '),
-            'USER...'.center(maximum_lcd_characters, ' ')
-        )
-        time.sleep(delay)
+        self.__write_lcd(*Message.INVALID_USER)
+        self.__pause(delay)
         
     #
     # logout/terminated - the user has logged out, or the client is shutting down
     #
 
     def __disable_power(self):
-        power_relay_pin = self.__opts.get(ClientOption.PIN_POWER_RELAY)
-        if self.__device.read(Channel.PIN, power_relay_pin):
+        is_powered = self.__device.read(Channel.PIN, self.__pin_power_relay)
+        if is_powered:
             is_machine_running = self.__wait_for_power_down()
             if is_machine_running:
                 self.__wait_for_logout_coast_time()
 
-        if self.__device.read(Channel.PIN, power_relay_pin):
-            self.__device.write(Channel.PIN, power_relay_pin, False)
+                # Only re-read the relay if we actually had to wait for the machine to stop
+                is_powered = self.__device.read(Channel.PIN, self.__pin_power_relay)
+
+        if is_powered:
+            self.__device.write(Channel.PIN, self.__pin_power_relay, False)
             self.__show_disabling_power()
 
     def __wait_for_power_down(self):
-        power_relay_pin = self.__opts.get(ClientOption.PIN_POWER_RELAY)
-        current_sense_pin = self.__opts.get(ClientOption.PIN_CURRENT_SENSE)
-        max_power_down_timeout = self.__opts.get(ClientOption.MAX_POWER_DOWN_TIMEOUT)
+        current_sense_pin = self.__pin_current_sense
+        max_power_down_timeout = self.__max_power_down_timeout
 
         if max_power_down_timeout is None:
             max_power_down_timeout = float('inf')
 
+        if not self.__device.read(Channel.PIN, current_sense_pin):
+            return False
+
+        # The prompt doesn't change while waiting, so it is only written once
+        self.__show_red_led()
+        self.__show_waiting_for_power_down()
+
         current = time.time()
-        is_machine_running = False
         while time.time() - current < max_power_down_timeout and self.__device.read(Channel.PIN, current_sense_pin):
-            is_machine_running = True
-            self.__show_red_led()
-            self.__show_waiting_for_power_down()
-            time.sleep(0.5)
+            remaining = max_power_down_timeout - (time.time() - current)
+            self.__device.wait_for_edge(current_sense_pin, self.__falling_edge, min(0.5, remaining))
 
-        return is_machine_running
+        return True
 
     def __wait_for_logout_coast_time(self):
         logout_coast_time = self.__opts.get(ClientOption.LOGOUT_COAST_TIME)
@@ -588,28 +708,16 @@ class Client(Machine):
             time.sleep(logout_coast_time)
 
     def __show_disabling_power(self, delay=0):
-        self.__device.write(
-            Channel.LCD,
-            'DISABLING'.center(maximum_lcd_characters, ' '),
-            'POWER...'.center(maximum_lcd_characters, ' ')
-        )
-        time.sleep(delay)
+        self.__write_lcd(*Message.DISABLING_POWER)
+        self.__pause(delay)
 
     def __show_waiting_for_power_down(self, delay=0):
-        self.__device.write(
-            Channel.LCD,
-            'WAITING FOR ...'.center(maximum_lcd_characters, ' '),
-            'MACHINE TO STOP'.center(maximum_lcd_characters, ' ')
-        )
-        time.sleep(delay)
+        self.__write_lcd(*Message.WAITING_FOR_POWER_DOWN)
+        self.__pause(delay)
 
     def __show_coasting_down(self, delay=0):
-        self.__device.write(
-            Channel.LCD,
-            'COASTING'.center(maximum_lcd_characters, ' '),
-            'DOWN...'.center(maximum_lcd_characters, ' ')
-        )
-        time.sleep(delay)
+        self.__write_lcd(*Message.COASTING_DOWN)
+        self.__pause(delay)
 
     def __handle_unexpected_exception(self):
         self.__show_red_led()
@@ -617,38 +725,30 @@ class Client(Machine):
         self.__show_please_try_again(2)
 
     def __show_error_occurred(self, delay=0):
-        self.__device.write(
-            Channel.LCD,
-            'THERE WAS AN'.center(maximum_lcd_characters, ' '),
-            'UNEXPECTED ERROR'.center(maximum_lcd_characters, ' ')
-        )
-        time.sleep(delay)
+        self.__write_lcd(*Message.ERROR_OCCURRED)
+        self.__pause(delay)
 
     def __show_please_try_again(self, delay=0):
-        self.__device.write(
-            Channel.LCD,
-            'PLEASE'.center(maximum_lcd_characters, ' '),
-            'TRY AGAIN...'.center(maximum_lcd_characters, ' ')
-        )
-        time.sleep(delay)
+        self.__write_lcd(*Message.PLEASE_TRY_AGAIN)
+        self.__pause(delay)
         
     #
     # a badge code has been detected on the serial input
     #
 
     def handle_badge_code(self, *args, **kwargs):
-        badge_code = kwargs.get('badge_code')
-        if self.state == State.IN_TRAINING:
-            if not self.__user_info:
-                if self.__activate_trainer(badge_code):
-                    self.__show_scan_student_badge()
-                else:
-                    self.__show_scan_trainer_badge()
-            else:
-                if not self.__is_current_badge_code(*args, **kwargs):
-                    self.__register_student(badge_code)
+        handler = self.__badge_code_handlers.get((self.state, bool(self.__user_info)), self.login)
+        handler(*args, **kwargs)
+
+    def __handle_trainer_badge_code(self, *args, **kwargs):
+        if self.__activate_trainer(kwargs.get('badge_code')):
+            self.__show_scan_student_badge()
         else:
-            self.login(*args, **kwargs)
+            self.__show_scan_trainer_badge()
+
+    def __handle_student_badge_code(self, *args, **kwargs):
+        if not self.__is_current_badge_code(*args, **kwargs):
+            self.__register_student(kwargs.get('badge_code'))
 
     #
     # logout_detected - logout button detected
@@ -674,15 +774,14 @@ class Client(Machine):
     #
 
     def estop_change(self, *args, **kwargs):
-        if self.is_estop_activated():
+        if self.__sample_estop():
             # E-Stop pushbutton was pressed
             if self.state != State.IN_TRAINING:
                 # Do not call estop() from in_training state, wait to call it upon exit from state
-                self.estop()
+                self.__preempt(self.estop)
         elif self.state == State.ESTOP:
             # E-Stop pushbutton was reset and in ESTOP state, wait for a potential bypass detect
-            time.sleep(0.5)
-            if self.is_bypass_detected():
+            if self.__is_bypass_detected_after_settling():
                 # Bypass detected so transition to bypass mode instead
                 self.bypass()
             else:
@@ -694,12 +793,12 @@ class Client(Machine):
     #
 
     def bypass_change(self, *args, **kwargs):
-        if self.is_bypass_detected():
+        if self.__sample_bypass_detect():
             # Bypass was detected
             if self.state == State.IDLE:
                 # Do not call bypass() from in_training state, wait to call it upon exit from state
                 # Only trigger positive edge change of bypass detect from IDLE state
-                self.bypass()
+                self.__preempt(self.bypass)
         elif self.state == State.BYPASSED:
             # Bypass detect was cleared and in BYPASSED state, trigger return to IDLE
             self.idle()
@@ -708,8 +807,9 @@ class Client(Machine):
     # wait - wait for the next edge detection event from the device.
     #
 
-    def wait(self):
-        self.__device.wait()
+    def wait(self, timeout=None):
+        # Bounded, so the main loop still re-checks for termination if no event ever arrives
+        self.__device.wait(min(timeout, maximum_wait_seconds) if timeout is not None else maximum_wait_seconds)
 
     #
     # status - The client has received a status command
@@ -719,53 +819,90 @@ class Client(Machine):
         return self.state
 
     def update_status(self, *args, **kwargs):
-        status_file = self.__opts.get(ClientOption.STATUS_FILE)
-        with open(status_file, 'w') as f:
-            f.write('{0}\n'.format(self.status()))
-            f.close()
+        # Self transitions (i.e. an extended session) leave the status unchanged
+        status = self.status()
+        if status == self.__last_status:
+            return
+
+        # Replace the file in one step, so the daemon never reads a partially written status
+        temp_file = '{0}.tmp'.format(self.__status_file)
+        with open(temp_file, 'w') as f:
+            f.write('{0}\n'.format(status))
+        os.rename(temp_file, self.__status_file)
+        self.__last_status = status
+
     #
     # conditions - used to allow/prevent triggers causing a transition if the conditions are not met.
     #
 
+    #
+    # The e-stop and bypass levels are cached, they are sampled when the inputs are registered and again
+    # by their edge callbacks, which are the only places that need a fresh read of the pin.
+    #
+
+    def __sample_estop(self):
+        # A single read of the pin, compared against the configured active level
+        self.__estop_activated = \
+            bool(self.__use_estop) and self.__device.read(Channel.PIN, self.__pin_estop) == self.__estop_active_hi
+        return self.__estop_activated
+
+    def __sample_bypass_detect(self):
+        self.__bypass_detected = \
+            bool(self.__use_bypass_detect and self.__device.read(Channel.PIN, self.__pin_bypass_detect))
+        return self.__bypass_detected
+
+    def __sample_inputs(self):
+        self.__sample_estop()
+        self.__sample_bypass_detect()
+
+    #
+    # start - registers the device callbacks and enters the initial state, the callbacks are held off
+    # until that state has been entered, so an edge that fires while they are being registered is
+    # handled against that state rather than racing it.
+    #
+
+    def start(self, registrations):
+        with self.__transition_lock:
+            self.__device.on_many(registrations)
+            self.reconcile()
+
+    #
+    # reconcile - samples the e-stop and bypass inputs and enters the resting state they call for.
+    #
+
+    def reconcile(self):
+        with self.__transition_lock:
+            self.__sample_inputs()
+            self.__resting_states[(self.__estop_activated, self.__bypass_detected)]()
+
     def is_estop_activated(self):
-        return self.__opts.get(ClientOption.USE_ESTOP) and (
-            (self.__opts.get(ClientOption.ESTOP_ACTIVE_HI) and self.__device.read(Channel.PIN, self.__opts.get(ClientOption.PIN_ESTOP))) or
-            (not self.__opts.get(ClientOption.ESTOP_ACTIVE_HI) and not self.__device.read(Channel.PIN, self.__opts.get(ClientOption.PIN_ESTOP)))
-        )
+        return self.__estop_activated
 
     def is_bypass_detected(self):
-        return self.__opts.get(ClientOption.USE_BYPASS_DETECT) and self.__device.read(Channel.PIN, self.__opts.get(ClientOption.PIN_BYPASS_DETECT))
+        return self.__bypass_detected
+
+    def __is_bypass_detected_after_settling(self):
+        # Only worth waiting on the bypass detect input when it is actually wired up
+        if not self.__use_bypass_detect:
+            return False
+
+        time.sleep(bypass_detect_settle_seconds)
+        return self.__sample_bypass_detect()
 
     def is_in_use(self):
         return self.status() == State.IN_USE or self.state == State.IN_TRAINING
 
     def is_normal_hours(self):
-        now = datetime.datetime.now().time()
-
-        start_time = self.__opts.get(ClientOption.DOOR_NORMAL_HR_START)
-        if start_time < 0:
-            start_time = 0
-        elif start_time > 2359:
-            start_time = 2359
-        start_hr = start_time / 100
-        start_min = start_time % 100
-        if start_min > 59:
-            start_min = 59
-        
-        end_time = self.__opts.get(ClientOption.DOOR_NORMAL_HR_END)
-        if end_time < 0:
-            end_time = 0
-        elif end_time > 2359:
-            end_time = 2359
-        end_hr = end_time / 100
-        end_min = end_time % 100
-        if end_min > 59:
-            end_min = 59
-        
-        start = datetime.time(start_hr, start_min)
-        end = datetime.time(end_hr, end_min)
-        return (start <= now <= end)
-    
+        now = datetime.datetime.now()
+        now_seconds = (now.hour * 60 + now.minute) * 60 + now.second
+        start, end = self.__normal_hours
+
+        if start <= end:
+            return start <= now_seconds <= end
+
+        # Normal hours that span midnight (i.e. 1800 to 0200)
+        return now_seconds >= start or now_seconds <= end
+
     def is_terminated(self):
         return self.status() == State.TERMINATED
 
@@ -778,12 +915,14 @@ class Client(Machine):
             self.__opts.get(ClientOption.DISABLE_TRAINING_MODE)):
             return False
         else:
-            current = time.time()
-            while (not self.is_terminated() and time.time() - current < training_mode_delay_seconds and
-                   self.__device.read(Channel.PIN, self.__opts.get(ClientOption.PIN_LOGOUT))):
-                time.sleep(0.1)
+            # Training mode is requested by holding the logout button until the delay expires
+            released = self.__device.wait_for_edge(
+                self.__pin_logout,
+                self.__falling_edge,
+                training_mode_delay_seconds
+            )
 
-            return self.__device.read(Channel.PIN, self.__opts.get(ClientOption.PIN_LOGOUT))
+            return released is None and self.__device.read(Channel.PIN, self.__pin_logout)
 
     def should_extend_current_session(self, *args, **kwargs):
         if self.__is_current_badge_code(*args, **kwargs):
@@ -818,9 +957,9 @@ class Client(Machine):
     def on_enter_idle(self, *args, **kwargs):
         self.__ensure_idle()
         # Wait to make sure bypass is not detected
-        time.sleep(0.5)
-        if self.is_bypass_detected():
-            self.bypass()
+        if self.__is_bypass_detected_after_settling():
+            # Raised from inside the idle transition, so it must run once this transition has completed
+            self.__raise_after_transition(self.bypass)
 
     def on_enter_unlocked(self, *args, **kwargs):
         self.__ensure_unlocked()
@@ -829,7 +968,8 @@ class Client(Machine):
 
     def on_enter_in_use(self, *args, **kwargs):
         self.__ensure_in_use()
-        self.__start_logout_timer()
+        # An extension re-enters in_use, so only restart the tick of a countdown that is already running
+        self.__refresh_logout_timer()
 
     def on_enter_in_training(self, *args, **kwargs):
         self.__ensure_training_mode()
@@ -842,74 +982,68 @@ class Client(Machine):
     def run(opts, args):
         logger = ClientLogger.setup(opts)
         reboot_delay = opts.get(ClientOption.REBOOT_DELAY) * 60
+        reboot_message = 'Rebooting in {0} minutes...'.format(reboot_delay / 60)
         reboot_on_error = opts.get(ClientOption.REBOOT_ON_ERROR)
+        niceness = opts.get(ClientOption.NICENESS)
+        pin_logout = opts.get(ClientOption.PIN_LOGOUT)
+        use_estop = opts.get(ClientOption.USE_ESTOP)
+        pin_estop = opts.get(ClientOption.PIN_ESTOP)
+        use_bypass_detect = opts.get(ClientOption.USE_BYPASS_DETECT)
+        pin_bypass_detect = opts.get(ClientOption.PIN_BYPASS_DETECT)
+
+        # Applied before any thread is started, so the edge callbacks, timers and main loop all inherit it
+        if niceness:
+            try:
+                os.nice(niceness)
+            except OSError as e:
+                logger.warning('Unable to change the client niceness to %s with \'%s\'.', niceness, e)
 
         try:
             with DeviceApi(opts) as device, \
                     Client(device, opts) as client, \
                     AutoUpdateTimer(client, opts) as auto_update_timer:
 
-                device.on(
-                    Channel.SERIAL,
-                    direction=device.GPIO.IN,
-                    call_back=client.handle_badge_code
-                )
-
-                device.on(
-                    Channel.PIN,
-                    pin=opts.get(ClientOption.PIN_LOGOUT),
-                    direction=device.GPIO.RISING,
-                    call_back=client.logout_detected
-                )
-
-                if opts.get(ClientOption.USE_ESTOP):
-
-                    device.on(
-                        Channel.PIN,
-                        pin=opts.get(ClientOption.PIN_ESTOP),
-                        direction=device.GPIO.BOTH,
-                        call_back=client.estop_change
-                    )
+                # noinspection PyPep8Naming
+                GPIO = device.GPIO
+                registrations = [
+                    (Channel.SERIAL, dict(direction=GPIO.IN, call_back=client.handle_badge_code)),
+                    (Channel.PIN, dict(pin=pin_logout, direction=GPIO.RISING, call_back=client.logout_detected))
+                ]
 
-                if opts.get(ClientOption.USE_BYPASS_DETECT):
+                if use_estop:
+                    registrations.append(
+                        (Channel.PIN, dict(pin=pin_estop, direction=GPIO.BOTH, call_back=client.estop_change))
+                    )
 
-                    device.on(
-                        Channel.PIN,
-                        pin=opts.get(ClientOption.PIN_BYPASS_DETECT),
-                        direction=device.GPIO.BOTH,
-                        call_back=client.bypass_change
+                if use_bypass_detect:
+                    registrations.append(
+                        (Channel.PIN, dict(pin=pin_bypass_detect, direction=GPIO.BOTH, call_back=client.bypass_change))
                     )
 
-                if client.is_estop_activated():
-                    client.estop()
-                elif client.is_bypass_detected():
-                    client.bypass()
-                else:
-                    client.idle()
+                client.start(registrations)
 
                 auto_update_timer.start()
+                debug_enabled = logger.isEnabledFor(logging.DEBUG)
+                pip_package_name = PackageInfo.pip_package_name
                 while not client.is_terminated():
-                    logger.debug('%s is waiting...', PackageInfo.pip_package_name)
-                    client.wait()
+                    if debug_enabled:
+                        logger.debug('%s is waiting...', pip_package_name)
+                    client.wait(auto_update_timer.seconds_until_update())
+                    auto_update_timer.update_if_due()
 
         except (KeyboardInterrupt, SystemExit) as e:
             pass
 
         except Exception as e:
-            logger.exception(e)
-
-            if reboot_on_error:
+            if logger.isEnabledFor(logging.ERROR):
+                logger.exception(e)
 
-                # reboot is only supported on Raspberry PI devices
-                # noinspection PyBroadException
+            # reboot is only supported on Raspberry PI devices, where the DeviceApi has already loaded RPi.GPIO
+            if reboot_on_error and 'RPi.GPIO' in sys.modules:
                 try:
-                    # noinspection PyUnresolvedReferences
-                    import RPi.GPIO
-                    logger.error('Rebooting in %s minutes...', reboot_delay / 60)
-                    CommandExecutor().execute_commands([
-                        'sleep {0}s'.format(reboot_delay),
-                        'reboot now'
-                    ])
-                except Exception:
-                    pass
+                    logger.error(reboot_message)
+                    time.sleep(reboot_delay)
+                    os.execvp('reboot', ['reboot', 'now'])
+                except OSError as e:
+                    logger.error('Reboot failed with \'%s\'.', e)
 
@@ -91,9 +91,9 @@ class ClientDaemon:
                         requested_package = '{0}=={1}'.format(requested_package, requested_version)
 
                     ClientDaemon.stop(opts, args)
-                    CommandExecutor().execute_commands([
-                        'pip install --upgrade --force-reinstall --ignore-installed --no-cache-dir {0}'
-                        .format(requested_package)
+                    CommandExecutor().execute_argv([
+                        'pip', 'install', '--upgrade', '--force-reinstall', '--ignore-installed', '--no-cache-dir',
+                        requested_package
                     ])
                 except Exception as e:
                     msg = '{0} update failed, remediation maybe required!'.format(PackageInfo.pip_package_name)
@@ -3,6 +3,7 @@ class ClientOption:
     DEBUG = 'debug'
     PID_FILE = 'pid_file'
     LOG_FILE = 'log_file'
+    NICENESS = 'niceness'
     LOG_LEVEL = 'log_level'
     DEVICE_ID = 'device_id'
     PIN_ESTOP = 'pin_estop'
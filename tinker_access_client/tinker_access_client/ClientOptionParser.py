@@ -15,6 +15,7 @@ ClientOptionDefaults = {
     ClientOption.DEVICE_ID: None,
     ClientOption.PIN_LED_BLUE: 20,
     ClientOption.REBOOT_DELAY: 300,
+    ClientOption.NICENESS: 0,
     ClientOption.PIN_LED_GREEN: 19,
     ClientOption.AUTO_UPDATE: False,
     ClientOption.FORCE_UPDATE: False,
@@ -244,6 +245,16 @@ class ClientOptionParser(object):
             action='store'
         )
 
+        self.__parser.add_option(
+            '--niceness',
+            help='the scheduling niceness to run the client with, a negative value gives the e-stop and other '
+                 'inputs priority over the rest of the system (requires root) [default:%default]',
+            default=ClientOptionDefaults[ClientOption.NICENESS],
+            dest=ClientOption.NICENESS,
+            type='int',
+            action='store'
+        )
+
         self.__parser.add_option(
             '--pin-logout',
             help='the logout pin [default:%default]',
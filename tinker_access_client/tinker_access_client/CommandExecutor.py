@@ -37,8 +37,11 @@ class CommandExecutor(object):
             os.remove(path)
 
     def execute_command(self, command):
+        self.execute_argv([command] + ['-evx'])  # Options: http://www.tldp.org/LDP/abs/html/options.html
+
+    def execute_argv(self, cmd):
+        # Runs the program directly without a shell, for commands that need no shell features or quoting
         try:
-            cmd = [command] + ['-evx']  # Options: http://www.tldp.org/LDP/abs/html/options.html
             cmd_process = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
             stdout_data, stderr_data = cmd_process.communicate()
             if cmd_process.returncode != 0:
@@ -1,5 +1,9 @@
+import os
 import time
 import math
+import errno
+import fcntl
+import select
 import json
 import serial
 import logging
@@ -7,6 +11,9 @@ import threading
 from LcdApi import LcdApi
 from ClientOptionParser import ClientOption
 
+# Long enough for the rest of a badge to arrive at 9600 baud once its first byte has, also the serial read timeout
+serial_settle_seconds = 0.1
+
 
 class Channel(object):
     LCD, SERIAL, LED, PIN = range(0, 4)
@@ -26,9 +33,19 @@ class DeviceApi(object):
         self.__fault = None
         self.__should_exit = False
         self.__edge_detected = False
+        self.__edge_detect_pins = set()
+
+        # Callbacks and stop() write to this pipe to wake the main thread blocked in wait(), the write end
+        # never blocks, and the pipe is kept for the life of the process so a late callback can not write
+        # into a reused descriptor.
+        self.__wake_read_fd, self.__wake_write_fd = os.pipe()
+        fcntl.fcntl(self.__wake_write_fd, fcntl.F_SETFL, fcntl.fcntl(self.__wake_write_fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+        self.__wait_fds = [self.__wake_read_fd]
+        self.__serial_call_back = None
         self.__first_line = ""
         self.__second_line = ""
-        self.__lcd_refresh_timer = None
+        self.__lcd_refresh_deadline = None
+        self.__lcd_refresh_interval = None
         self.__write_lcd_lock = threading.Lock()
         self.__logger = logging.getLogger(__name__)
 
@@ -51,9 +68,14 @@ class DeviceApi(object):
         # noinspection PyUnresolvedReferences
         import RPi.GPIO as GPIO
         GPIO.setmode(GPIO.BCM)
-        GPIO.setup(self.__opts.get(ClientOption.PIN_LED_RED), GPIO.OUT)
-        GPIO.setup(self.__opts.get(ClientOption.PIN_LED_BLUE), GPIO.OUT)
-        GPIO.setup(self.__opts.get(ClientOption.PIN_LED_GREEN), GPIO.OUT)
+        # The LED pins are written on every color change, so they are only looked up once
+        self.__led_pins = (
+            self.__opts.get(ClientOption.PIN_LED_RED),
+            self.__opts.get(ClientOption.PIN_LED_GREEN),
+            self.__opts.get(ClientOption.PIN_LED_BLUE)
+        )
+        for pin in self.__led_pins:
+            GPIO.setup(pin, GPIO.OUT)
         GPIO.setup(self.__opts.get(ClientOption.PIN_POWER_RELAY), GPIO.OUT)
         GPIO.setup(self.__opts.get(ClientOption.PIN_LOGOUT), GPIO.IN, GPIO.PUD_DOWN)
 
@@ -137,7 +159,8 @@ class DeviceApi(object):
     def __configure_serial(self):
         serial_port_name = self.__opts.get(ClientOption.SERIAL_PORT_NAME)
         serial_port_speed = self.__opts.get(ClientOption.SERIAL_PORT_SPEED)
-        self.__serial_connection = serial.Serial(serial_port_name, serial_port_speed)
+        # Badges are read on the main thread, so a line that never ends (i.e. line noise) must not block it
+        self.__serial_connection = serial.Serial(serial_port_name, serial_port_speed, timeout=serial_settle_seconds)
         self.__serial_connection.flushInput()
         self.__serial_connection.flushOutput()
 
@@ -147,6 +170,15 @@ class DeviceApi(object):
 
     def __stop(self):
         self.__should_exit = True
+        self.__wake()
+
+    def __wake(self):
+        try:
+            os.write(self.__wake_write_fd, b'.')
+        except OSError as e:
+            # A full pipe already has a wake up pending
+            if e.errno != errno.EAGAIN:
+                raise e
 
     # noinspection PyBroadException
     def __do_cleanup(self):
@@ -169,26 +201,31 @@ class DeviceApi(object):
             self.__stop()
         finally:
             self.__edge_detected = True
+            self.__wake()
 
-    def __poll_for_serial_input(self, call_back):
-        while not self.__should_exit:
-            try:
-                badge_code = self.read(Channel.SERIAL)
-                if badge_code:
-                    self.__do_callback(call_back, badge_code=badge_code)
-            except Exception as e:
-                self.__fault = e
-                self.__stop()
-            time.sleep(.5)
+    def __handle_serial_input(self):
+        badge_code = self.read(Channel.SERIAL)
+        if badge_code is None and not self.__should_exit:
+            # Too little input for a badge, give a scan that is still arriving time to finish, then drop
+            # whatever is left (i.e. line noise) so the port does not stay readable and spin the main loop.
+            time.sleep(serial_settle_seconds)
+            badge_code = self.read(Channel.SERIAL)
+            if badge_code is None:
+                self.__serial_connection.flushInput()
+
+        if badge_code:
+            self.__do_callback(self.__serial_call_back, badge_code=badge_code)
 
     def __read_from_serial(self):
         serial_connection = self.__serial_connection
 
         if serial_connection.inWaiting() > 1:
-            value = serial_connection.readline().strip()[-12:]
+            line = serial_connection.readline()
             serial_connection.flushInput()
             serial_connection.flushOutput()
-            return value
+
+            # A line cut short by the read timeout is noise, or a scan that stalled, rather than a badge
+            return line.strip()[-12:] if line.endswith('\n') else None
 
         return None
 
@@ -201,9 +238,10 @@ class DeviceApi(object):
     def __write_to_led(self, red, green, blue):
         # noinspection PyPep8Naming
         GPIO = self.GPIO
-        GPIO.output(self.__opts.get(ClientOption.PIN_LED_RED), red)
-        GPIO.output(self.__opts.get(ClientOption.PIN_LED_GREEN), green)
-        GPIO.output(self.__opts.get(ClientOption.PIN_LED_BLUE), blue)
+        pin_led_red, pin_led_green, pin_led_blue = self.__led_pins
+        GPIO.output(pin_led_red, red)
+        GPIO.output(pin_led_green, green)
+        GPIO.output(pin_led_blue, blue)
 
         # Retry backlight write multiple times, then raise error if unsuccessful
         num_attempts = 5
@@ -252,9 +290,8 @@ class DeviceApi(object):
 
     def __call_lcd_write(self, first_line, second_line):
         try:
-            self.__cancel_lcd_refresh_timer()
             with LcdApi(self.__opts) as lcd:
-                lcd.write(first_line, second_line)
+                lcd.write_frame(first_line, second_line)
         except Exception as e:
             self.__logger.debug('LCD I2C write message failed with message \'%s %s\'.', first_line, second_line)
             self.__logger.exception(e)
@@ -263,10 +300,7 @@ class DeviceApi(object):
         self.__start_lcd_refresh_timer()
 
     def __cancel_lcd_refresh_timer(self):
-        if self.__lcd_refresh_timer:
-            self.__lcd_refresh_timer.cancel()
-
-        self.__lcd_refresh_timer = None
+        self.__lcd_refresh_deadline = None
 
     def __lcd_refresh_timer_tick(self):
         try:
@@ -277,12 +311,12 @@ class DeviceApi(object):
             self.__stop()
 
     def __start_lcd_refresh_timer(self, interval=30):
-        self.__cancel_lcd_refresh_timer()
-        self.__lcd_refresh_timer = threading.Timer(
-            interval,
-            self.__lcd_refresh_timer_tick
-        )
-        self.__lcd_refresh_timer.start()
+        # The refresh is run by the main thread in wait(), which only needs waking if no refresh was pending
+        was_pending = self.__lcd_refresh_deadline is not None
+        self.__lcd_refresh_interval = interval
+        self.__lcd_refresh_deadline = time.time() + interval
+        if not was_pending:
+            self.__wake()
 
     def __write_to_pin(self, pin, state):
         # noinspection PyPep8Naming
@@ -298,6 +332,8 @@ class DeviceApi(object):
         # noinspection PyPep8Naming
         GPIO = self.GPIO
         if channel is Channel.PIN and pin and direction and call_back:
+            # RPi.GPIO waits on every edge detected pin from a single epoll thread, and calls these handlers
+            # on it one at a time, so the settle delays below also hold off edges on the other pins.
 
             def rising_edge_detected(*args, **kwargs):
                 pin = args[0]
@@ -324,18 +360,21 @@ class DeviceApi(object):
             else:
                 raise NotImplementedError
 
+            self.__edge_detect_pins.add(pin)
+
         elif channel is Channel.SERIAL and direction is self.GPIO.IN and call_back:
-            poll_for_serial_input = threading.Thread(
-                name='poll_for_serial_input',
-                target=self.__poll_for_serial_input,
-                args=(call_back,)
-            )
-            poll_for_serial_input.daemon = True
-            poll_for_serial_input.start()
+            # Serial input is handled by the main thread as it becomes readable in wait()
+            self.__serial_call_back = call_back
+            self.__wait_fds.append(self.__serial_connection.fileno())
 
         else:
             raise NotImplementedError
 
+    def on_many(self, registrations):
+        # Registers every (channel, kwargs) pair in one call, so they are all armed before it returns
+        for channel, kwargs in registrations:
+            self.on(channel, **kwargs)
+
     def read(self, channel, *args):
         if self.__should_exit:
             return
@@ -391,9 +430,69 @@ class DeviceApi(object):
             self.__logger.exception(e)
             raise e
 
-    def wait(self):
+    def write_lcd_frame(self, first_line, second_line=''):
+        self.write(Channel.LCD, first_line, second_line)
+
+    def write_led(self, colors):
+        self.write(Channel.LED, *colors)
+
+    def wait_for_edge(self, pin, direction, timeout):
+        if self.__should_exit:
+            return
+
+        # noinspection PyPep8Naming
+        GPIO = self.GPIO
+        if pin not in self.__edge_detect_pins:
+            # Blocks in the kernel until the edge occurs, returns None if the timeout expires first,
+            # RPi.GPIO rejects a timeout below 1ms so the tail of a caller's deadline is rounded up to it
+            return GPIO.wait_for_edge(pin, direction, timeout=max(1, int(timeout * 1000)))
+
+        # RPi.GPIO does not allow wait_for_edge on a pin that already has edge detection enabled,
+        # so fall back to sampling the pin until it reaches the state that follows the edge.
+        expected_state = GPIO.HIGH if direction == GPIO.RISING else GPIO.LOW
+        current = time.time()
+        while time.time() - current < timeout:
+            if GPIO.input(pin) == expected_state:
+                return pin
+            time.sleep(.1)
+
+        return None
+
+    def wait(self, timeout=None):
+        deadline = time.time() + timeout if timeout is not None else None
         while not self.__should_exit and not self.__edge_detected:
-            time.sleep(1)
+            now = time.time()
+
+            # Deadlines further out than their interval mean the wall clock was set back, so restart them from now
+            if deadline is not None and deadline - now > timeout:
+                deadline = now + timeout
+
+            lcd_refresh_deadline = self.__lcd_refresh_deadline
+            if lcd_refresh_deadline is not None and lcd_refresh_deadline - now > self.__lcd_refresh_interval:
+                self.__start_lcd_refresh_timer(self.__lcd_refresh_interval)
+                continue
+
+            if lcd_refresh_deadline is not None and now >= lcd_refresh_deadline:
+                self.__lcd_refresh_timer_tick()
+                continue
+
+            if deadline is not None and now >= deadline:
+                break
+
+            deadlines = [d for d in (deadline, lcd_refresh_deadline) if d is not None]
+            try:
+                readable, _, _ = select.select(self.__wait_fds, [], [], min(deadlines) - now if deadlines else None)
+            except select.error as e:
+                if e.args[0] != errno.EINTR:
+                    raise e
+                continue
+
+            if not readable:
+                continue
+            elif self.__wake_read_fd in readable:
+                os.read(self.__wake_read_fd, 4096)
+            else:
+                self.__handle_serial_input()
         self.__edge_detected = False
         self.__raise_fault()
 
@@ -229,6 +229,28 @@ class LcdApi(object):
 	self.lcd_display_string(first_line, 1, 0)
 	self.lcd_display_string(second_line, 2, 0)
 
+    # Write both lines to the LCD in as few bus transactions as possible, called from outside
+    def write_frame(self, first_line, second_line):
+        if self.__serlcd:
+            # SerLCD, a whole frame does not fit in a single 32 byte block write, so send it a line per block
+            self.lcd_display_string(first_line, 1, 0)
+            self.lcd_display_string(second_line, 2, 0)
+
+        else:
+            # Backpack, queue every latched nibble along with its enable strobe instead of writing them one at a time
+            frame = [(LCD_SETDDRAMADDR, 0)] + [(ord(char), Rs) for char in first_line] + \
+                    [(LCD_SETDDRAMADDR | 0x40, 0)] + [(ord(char), Rs) for char in second_line]
+
+            data = []
+            for value, mode in frame:
+                for nibble in (mode | (value & 0xF0), mode | ((value << 4) & 0xF0)):
+                    data += [nibble | LCD_BACKLIGHT, nibble | En | LCD_BACKLIGHT, (nibble & ~En) | LCD_BACKLIGHT]
+
+            # The first byte goes out as the block command, so each block carries 33 bytes (eleven nibbles)
+            for i in range(0, len(data), 33):
+                block = data[i:i + 33]
+                self.lcd_device.write_block_data(block[0], block[1:])
+
     # Set the RGB backlight (SerLCD only)
     def rgb_backlight(self, red, green, blue):
         if self.__serlcd:
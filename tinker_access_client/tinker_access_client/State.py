@@ -8,3 +8,7 @@ class State(object):
     IN_USE = 'in_use'
     IN_TRAINING = 'in_training'
     TERMINATED = 'terminated'
+
+
+# Collected once at import, rather than by every Client that builds its state machine
+State.ALL = tuple(value for key, value in vars(State).items() if not key.startswith('__'))